@@ -22,7 +22,9 @@ setup(name='zplconvert',
       entry_points={
           'console_scripts': [
               'zplconvert = zplconvert.main:main',
-              'zplparse = zplconvert.zplparser:main'
+              'zplparse = zplconvert.zplparser:main',
+              'zplemulator = zplconvert.zplemulator:main',
+              'zplload = zplconvert.zplload:main'
           ]
       },
       keywords='zebra zpl convert converter',
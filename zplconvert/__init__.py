@@ -1,7 +1,9 @@
 #!/usr/bin/env python
 
-from .zplconvert import ZPLConvert
+from .zplconvert import ZPLConvert, ZPLBitmap, PRINTER_PROFILES
 from .zplparser import zpl_parse
 from .zpltools import Printer, PrinterError
+from .zplemulator import PrinterEmulator
+from .zpltext import ZPLText
 
 __version__ = '0.0.4'
@@ -4,8 +4,9 @@
 Helper utility for using the ZPL converter.
 """
 
+import sys
 import argparse
-from zplconvert import ZPLConvert
+from zplconvert import ZPLConvert, ZPLBitmap, PRINTER_PROFILES
 
 def parse_args():
     """
@@ -19,6 +20,14 @@ def parse_args():
                           help="Compress the result image (default yes)")
     compress.add_argument('--no-compress', '-n', action='store_false',
                           dest='compress', help="Do not compress the result")
+    parser.add_argument('--encoding', '-e', choices=ZPLBitmap.ENCODINGS + ('auto',),
+                        help="Image encoding, overrides compression, "
+                        "'auto' selects the smallest one")
+    parser.add_argument('--profile', choices=sorted(PRINTER_PROFILES), default='zpl2',
+                        help="Encodings the printer accepts, for --encoding auto "
+                        "(default zpl2)")
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help="Report the selected encoding and sizes to stderr")
     parser.add_argument('--position', '-p', help="Add position header (x,y)")
     convert = parser.add_mutually_exclusive_group(required=False)
     convert.add_argument('--threshold', '-t', default=128, type=int,
@@ -31,9 +40,18 @@ def parse_args():
                         help="Output filename, or stdout if not defined")
     parser.add_argument('--upload', '-u',
                         help="Return data suitable for direct upload")
+    parser.add_argument('--workers', '-w', type=int, default=1,
+                        help="Encode large images in parallel, 0 for all CPUs (default 1)")
+    parser.add_argument('--chunk-rows', default=4096, type=int,
+                        help="Rows per parallel chunk (default 4096)")
     parser.add_argument('filename', help="Source filename, or '-' for stdin")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+    if args.upload and args.encoding in ZPLBitmap.ENCODINGS and \
+            args.encoding not in ZPLBitmap.UPLOAD_ENCODINGS:
+        parser.error("--encoding %s is not supported with --upload" % args.encoding)
+
+    return args
 
 def main():
     """
@@ -44,8 +62,11 @@ def main():
     args = parse_args()
     converter = ZPLConvert(args.filename)
     converter.set_compress_hex(args.compress)
+    if args.encoding:
+        converter.set_encoding(args.encoding, args.profile)
     converter.set_black_threshold(args.threshold)
     converter.set_dither(args.dither)
+    converter.set_parallel(args.workers or None, args.chunk_rows)
 
     # Set position
     # pylint: disable=invalid-name
@@ -53,10 +74,20 @@ def main():
     if args.position:
         x, y = (int(val) for val in args.position.split(','))
 
+    # Decode image only once, also when reporting
+    bitmap = converter.get_bitmap()
+    if args.verbose:
+        encoding, sizes = converter.select_encoding(bitmap, upload=bool(args.upload))
+        if sizes:
+            print >> sys.stderr, "Encoding: %s (%s)" % (encoding, ", ".join(
+                "%s %d" % (key, sizes[key]) for key in sorted(sizes, key=sizes.get)))
+        else:
+            print >> sys.stderr, "Encoding: %s" % encoding
+
     if args.upload:
-        result = converter.convert_for_upload(args.upload)
+        result = converter.convert_for_upload(args.upload, bitmap)
     else:
-        result = converter.convert(label=args.label, x=x, y=y)
+        result = converter.convert(bitmap, label=args.label, x=x, y=y)
 
     # Write result to file or to stdout
     if args.output:
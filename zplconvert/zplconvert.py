@@ -3,108 +3,283 @@ Converter for generating ZPL images.
 """
 
 import sys
+import zlib
+import base64
+import threading
+import multiprocessing
+from binascii import hexlify, crc_hqx
+from itertools import groupby
 from cStringIO import StringIO
 from PIL import Image
 
-def _int_to_hex(value, upper=False):
+# Graphic field encodings accepted by printers
+# 'ascii' for text-only connections, 'z64' for firmware with :Z64: support
+PRINTER_PROFILES = {
+    'ascii': ('hex', 'compressed'),
+    'zpl2': ('hex', 'compressed', 'binary'),
+    'z64': ('hex', 'compressed', 'binary', 'z64'),
+}
+
+def _to_bytes(data):
+    """
+    Get the contents of a bytes-like object as a string.
     """
-    Convert int value to hex.
+    if isinstance(data, str):
+        return data
+    if not isinstance(data, unicode):
+        try:
+            return memoryview(data).tobytes()
+        except TypeError:
+            pass
+        # Objects such as array.array only support the old buffer interface
+        try:
+            return str(buffer(data))
+        except TypeError:
+            pass
+    raise TypeError("Bytes-like data required (%s given)" % type(data).__name__)
+
+def _open_image(source):
     """
-    result = ('0' + hex(value)[2:])[-2:]
-    return result.upper() if upper else result
+    Open an image from a filename, '-' for stdin, image data or a file-like object.
+    """
+    if isinstance(source, Image.Image):
+        return source
+    if isinstance(source, (bytearray, memoryview, buffer)):
+        return Image.open(StringIO(_to_bytes(source)))
+    if hasattr(source, 'read'):
+        return Image.open(source)
+    if isinstance(source, basestring) and source == '-':
+        return Image.open(StringIO(sys.stdin.read()))
+    return Image.open(source)
 
 def _get_compress(counter, char):
     """
     Get compressed bytes for a character.
+
+    >>> _get_compress(3, 'F')
+    'IF'
+    >>> _get_compress(841, 'F')
+    'zzhGF'
     """
     retval = ""
+    # Multipliers are additive, so repeat the largest one as needed
+    if counter > 400:
+        retval = ZPLConvert.multiplier[400] * (counter / 400)
+        counter %= 400
+        if counter == 0:
+            return retval + char
+        elif counter <= 2:
+            return retval + ZPLConvert.multiplier[counter] + char
     if counter > 20:
         mult = (counter / 20) * 20
         rest = (counter % 20)
-        retval = ZPLConvert.multiplier[mult]
+        retval += ZPLConvert.multiplier[mult]
         if rest != 0:
             retval += ZPLConvert.multiplier[rest]
     # Add multiplier only if counter is larger than 2
     elif counter > 2:
-        retval = ZPLConvert.multiplier[counter]
+        retval += ZPLConvert.multiplier[counter]
     # Repeat twice, if necessary
     elif counter == 2:
-        retval = char
+        retval += char
 
     # Always add the actual character
     return retval + char
 
-class ZPLConvert(object):
+def _compress_row(row):
     """
-    Convert any image to ZPL representation.
+    Compress a single hex row.
+    """
+    runs = [(char, sum(1 for _ in group)) for char, group in groupby(row)]
+    last_char, last_counter = runs.pop()
+    line = ''.join(_get_compress(counter, char) for char, counter in runs)
+
+    # Continue white
+    if last_char == '0':
+        return line + ','
+    # Continue black
+    elif last_char == 'f':
+        return line + '!'
+    # Repeat last character
+    return line + _get_compress(last_counter, last_char)
+
+def _encode_rows(args):
+    """
+    Encode packed rows of bits to hex, optionally compressed.
+    Returns the encoded rows and the first and last compressed rows.
+    """
+    data, width_bytes, compress = args
+    rows = [hexlify(data[idx:idx + width_bytes]) for idx in xrange(0, len(data), width_bytes)]
+
+    if not compress:
+        return ''.join(row + '\n' for row in rows), None, None
+
+    result = []
+    first = None
+    line = None
+    prev = None
+    for row in rows:
+        # Repeat previous line, identical rows compress identically
+        if row == prev:
+            result.append(':')
+            continue
+        line = _compress_row(row)
+        result.append(line)
+        if first is None:
+            first = line
+        prev = row
+
+    return ''.join(result), first, line
+
+def _stitch_rows(parts):
+    """
+    Join encoded row chunks, repeating the previous line across chunk boundaries.
+    """
+    result = []
+    last = None
+    for body, first, chunk_last in parts:
+        if first is not None and first == last:
+            body = ':' + body[len(first):]
+        result.append(body)
+        last = chunk_last
+    return ''.join(result)
+
+def _encode_data(data, width_bytes, compress, workers=1, chunk_rows=4096):
+    """
+    Encode packed rows of bits. Compression is done in parallel chunks of
+    rows if workers > 1, the output is the same as when done serially.
+
+    >>> data = ('ff00' * 3 + '0ff0' * 2 + 'ff00').decode('hex')
+    >>> print _encode_data(data, 2, True)
+    ff,::0ff,:ff,
+    >>> _encode_data(data, 2, True, workers=2, chunk_rows=1) == _encode_data(data, 2, True)
+    True
+    """
+    # Split into chunks of whole rows, plain hex is too cheap to parallelize
+    chunk_size = chunk_rows * width_bytes
+    if workers == 1 or not compress or len(data) <= chunk_size:
+        return _encode_rows((data, width_bytes, compress))[0]
+
+    chunks = [(data[idx:idx + chunk_size], width_bytes, compress)
+              for idx in xrange(0, len(data), chunk_size)]
+    pool = multiprocessing.Pool(min(workers, len(chunks)))
+    try:
+        parts = pool.map(_encode_rows, chunks)
+    finally:
+        pool.close()
+        pool.join()
+
+    return _stitch_rows(parts)
+
+class ZPLBitmap(object):
+    """
+    Immutable 1-bit image, ready for rendering as ZPL.
+    Bits are packed 8 pixels per byte, each row padded to whole bytes,
+    with set bits printed black. Encoded payloads are computed once per
+    encoding, so a bitmap can be rendered any number of times and safely
+    shared between threads.
     """
 
-    # pylint: disable=no-self-use,invalid-name
-
-    # Convert length multiplier to character code
-    # G - Y = 1 - 19, g - z = 20 - 400
-    multiplier = dict([(i, chr(ord('F') + i)) for i in xrange(1, 20)] + \
-                      [(20 * i, chr(ord('f') + i)) for i in xrange(1, 21)])
-
-    def __init__(self, filename=None):
-        self._filename = filename
-        self._compress = False
-        self._threshold = 128
-        self._total = 0
-        self._width_bytes = 0
-        self._dither = False
+    # pylint: disable=invalid-name
+
+    # hex and compressed are ASCII hex (^GFA), binary is raw bytes (^GFB) and
+    # z64 is zlib compressed and base64 encoded (^GFA with :Z64: data)
+    ENCODINGS = ('hex', 'compressed', 'binary', 'z64')
+
+    # Encodings supported by ~DG
+    UPLOAD_ENCODINGS = ('hex', 'compressed')
+
+    def __init__(self, data, width, height):
+        width_bytes = (width + 7) / 8
+        data = _to_bytes(data)
+        if len(data) != width_bytes * height:
+            raise ValueError("Bitmap data must be %d bytes (%d given)" % (
+                width_bytes * height, len(data)))
+        self._data = data
+        self._width = width
+        self._height = height
+        self._width_bytes = width_bytes
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    @property
+    def data(self):
+        """
+        Packed bitmap bytes.
+        """
+        return self._data
 
-    def set_compress_hex(self, compress=True):
+    @property
+    def width(self):
         """
-        Compress hex result or not.
+        Width in pixels.
         """
-        self._compress = compress
+        return self._width
 
-    def set_black_threshold(self, threshold):
+    @property
+    def height(self):
         """
-        Set black pixel threshold.
+        Height in pixels.
         """
-        if threshold < 0 or threshold > 255:
-            raise ValueError("Black threshold must be between 0 and 255 (%d given)" % threshold)
-        self._threshold = threshold
+        return self._height
 
-    def set_dither(self, dither):
+    @property
+    def width_bytes(self):
         """
-        Dither the image instead of using a hard limit.
+        Bytes per row.
         """
-        self._dither = dither
+        return self._width_bytes
 
-    def convert_for_upload(self, targetfile, filename=None):
+    @property
+    def total(self):
         """
-        Returns code suitable for uploading graphics directly on the printer.
+        Total bytes in the uncompressed bitmap.
         """
-        filename = filename or self._filename
-        if not filename:
-            raise ValueError("No filename given")
+        return self._width_bytes * self._height
 
-        # Create image body
-        body = self._create_body(filename)
+    def encode(self, encoding='hex', workers=1, chunk_rows=4096):
+        """
+        Get encoded image body, computed only on first use.
+        Workers and chunk_rows control parallel encoding, see ZPLConvert.set_parallel.
+        """
+        if encoding not in self.ENCODINGS:
+            raise ValueError("Unknown encoding %r" % encoding)
 
-        return self._get_upload_header(targetfile) + body
+        with self._lock:
+            if encoding not in self._encoded:
+                self._encoded[encoding] = self._encode(encoding, workers, chunk_rows)
+            return self._encoded[encoding]
 
-    def convert(self, filename=None, label=False, x=None, y=None):
+    def encoded_size(self, encoding='hex', **kwargs):
         """
-        Convert a file to ZPL.
-        Returns a full ZPL-compatible image with optional headers.
+        Get size of encoded image body.
+        Sizes of hex and binary bodies are calculated without encoding.
         """
-        filename = filename or self._filename
-        if not filename:
-            raise ValueError("No filename given")
+        if encoding == 'hex':
+            return (self._width_bytes * 2 + 1) * self._height
+        if encoding == 'binary':
+            return self.total
+        return len(self.encode(encoding, **kwargs))
 
-        # Create image body
-        body = self._create_body(filename)
+    def select_encoding(self, allowed=ENCODINGS, **kwargs):
+        """
+        Find the smallest of the allowed encodings.
+        Returns the encoding and a dict of sizes for all allowed encodings.
+        """
+        if not allowed:
+            raise ValueError("No encodings allowed")
+        sizes = dict((encoding, self.encoded_size(encoding, **kwargs)) for encoding in allowed)
+        return min(allowed, key=lambda encoding: sizes[encoding]), sizes
 
-        # Compress it, if selected
-        if self._compress:
-            body = self._compress_hex(body)
+    def to_zpl(self, label=False, x=None, y=None, encoding='hex', **kwargs):
+        """
+        Returns a full ZPL-compatible image with optional headers.
+        """
+        body = self.encode(encoding, **kwargs)
+        fmt = 'B' if encoding == 'binary' else 'A'
 
         # Add header and footer, with optional coordinates
-        image = self._get_header(len(body), x, y) + body + self._get_footer()
+        image = self._get_header(len(body), x, y, fmt) + body + self._get_footer()
 
         # Add label start and stop bytes
         if label:
@@ -112,15 +287,35 @@ class ZPLConvert(object):
 
         return image
 
-    def _get_header(self, size, x=None, y=None):
+    def to_upload(self, targetfile, encoding='hex', **kwargs):
+        """
+        Returns code suitable for uploading graphics directly on the printer.
+        """
+        if encoding not in self.UPLOAD_ENCODINGS:
+            raise ValueError("Encoding %r not supported for upload" % encoding)
+        return self._get_upload_header(targetfile) + self.encode(encoding, **kwargs)
+
+    def _encode(self, encoding, workers, chunk_rows):
+        """
+        Encode image body.
+        """
+        if encoding == 'binary':
+            return self._data
+        if encoding == 'z64':
+            data = base64.b64encode(zlib.compress(self._data, 9))
+            return ":Z64:{data}:{crc:04x}".format(data=data, crc=crc_hqx(data, 0))
+        return _encode_data(self._data, self._width_bytes, encoding == 'compressed',
+                            workers, chunk_rows)
+
+    def _get_header(self, size, x=None, y=None, fmt='A'):
         """
         Get header, with optional positioning.
         """
         pos = ""
         if x is not None and y is not None:
             pos = "^FO{x},{y}".format(x=x, y=y)
-        return pos + "^GFA,{size},{total},{width_bytes},".format(
-            size=size, total=self._total, width_bytes=self._width_bytes)
+        return pos + "^GF{fmt},{size},{total},{width_bytes},".format(
+            fmt=fmt, size=size, total=self.total, width_bytes=self._width_bytes)
 
     def _get_footer(self):
         """
@@ -137,101 +332,164 @@ class ZPLConvert(object):
             targetfile = 'R:' + targetfile
 
         return "~DG{targetfile},{total},{width_bytes},".format(
-            targetfile=targetfile, total=self._total, width_bytes=self._width_bytes)
+            targetfile=targetfile, total=self.total, width_bytes=self._width_bytes)
+
+class ZPLConvert(object):
+    """
+    Convert any image to ZPL representation.
+    The converter only holds settings, so it can be shared between threads
+    as long as the settings are not changed while converting.
+    """
+
+    # pylint: disable=no-self-use,invalid-name
 
-    def _get_bw_image(self, filename):
+    # Convert length multiplier to character code
+    # G - Y = 1 - 19, g - z = 20 - 400
+    multiplier = dict([(i, chr(ord('F') + i)) for i in xrange(1, 20)] + \
+                      [(20 * i, chr(ord('f') + i)) for i in xrange(1, 21)])
+
+    def __init__(self, filename=None):
+        self._filename = filename
+        self._encoding = 'hex'
+        self._profile = PRINTER_PROFILES['zpl2']
+        self._threshold = 128
+        self._dither = False
+        self._workers = 1
+        self._chunk_rows = 4096
+
+    def set_compress_hex(self, compress=True):
         """
-        Convert image to black and white.
-        Also update image size.
+        Compress hex result or not.
+        """
+        self._encoding = 'compressed' if compress else 'hex'
+
+    def set_encoding(self, encoding, profile=None):
+        """
+        Set image encoding, or 'auto' to use the smallest one the printer accepts.
+        Profile is a name in PRINTER_PROFILES or a list of encodings, and
+        limits the choice of 'auto' (default 'zpl2').
+        """
+        if encoding != 'auto' and encoding not in ZPLBitmap.ENCODINGS:
+            raise ValueError("Unknown encoding %r" % encoding)
+        if profile is not None:
+            if isinstance(profile, basestring):
+                if profile not in PRINTER_PROFILES:
+                    raise ValueError("Unknown printer profile %r" % profile)
+                profile = PRINTER_PROFILES[profile]
+            profile = tuple(profile)
+            if not profile or not set(profile) <= set(ZPLBitmap.ENCODINGS):
+                raise ValueError("Invalid printer profile %r" % (profile,))
+            self._profile = profile
+        self._encoding = encoding
+
+    def select_encoding(self, bitmap, upload=False):
+        """
+        Get encoding for a bitmap.
+        Returns the encoding and a dict of sizes of the encodings considered,
+        which is empty unless the encoding is 'auto'.
+        """
+        if self._encoding != 'auto':
+            return self._encoding, {}
+        allowed = self._profile
+        if upload:
+            allowed = tuple(enc for enc in allowed if enc in ZPLBitmap.UPLOAD_ENCODINGS)
+        return bitmap.select_encoding(allowed, workers=self._workers,
+                                      chunk_rows=self._chunk_rows)
+
+    def set_black_threshold(self, threshold):
+        """
+        Set black pixel threshold.
+        """
+        if threshold < 0 or threshold > 255:
+            raise ValueError("Black threshold must be between 0 and 255 (%d given)" % threshold)
+        self._threshold = threshold
+
+    def set_dither(self, dither):
         """
+        Dither the image instead of using a hard limit.
+        """
+        self._dither = dither
 
-        source = StringIO(sys.stdin.read()) if filename == '-' else filename
+    def set_parallel(self, workers=None, chunk_rows=4096):
+        """
+        Encode large images in chunks of rows using a pool of worker processes.
+        Workers defaults to the number of CPUs, 1 disables parallel encoding.
+        Images with no more than chunk_rows rows are always encoded serially.
+        """
+        if workers is not None and workers < 1:
+            raise ValueError("Worker count must be at least 1 (%d given)" % workers)
+        if chunk_rows < 1:
+            raise ValueError("Chunk size must be at least 1 row (%d given)" % chunk_rows)
+        self._workers = workers or multiprocessing.cpu_count()
+        self._chunk_rows = chunk_rows
+
+    def get_bitmap(self, filename=None, size=None):
+        """
+        Decode and binarize an image once.
+        The source can be a filename or '-' for stdin, a PIL image, encoded
+        image data as a bytearray, memoryview or buffer, or a file-like object.
+        Without size, a str is always treated as a filename.
+        If size (width, height) is given, the source, including a str, is
+        already packed 1-bit data with set bits black, and is used without
+        decoding.
+        Returns a ZPLBitmap that can be rendered any number of times.
+        """
+        source = filename if filename is not None else self._filename
+        if source is None or (isinstance(source, basestring) and source == ''):
+            raise ValueError("No filename given")
 
-        # Load image and get dimensions
-        image = Image.open(source)
-        width, height = image.size
+        if isinstance(source, ZPLBitmap):
+            return source
+        if size is not None:
+            width, height = size
+            return ZPLBitmap(source, width, height)
 
-        if self._dither:
+        bwimage = self._get_bw_image(source)
+        width, height = bwimage.size
+        return ZPLBitmap(bwimage.tobytes(), width, height)
+
+    def convert_for_upload(self, targetfile, filename=None, size=None):
+        """
+        Returns code suitable for uploading graphics directly on the printer.
+        See get_bitmap for supported sources.
+        Raises ValueError if the encoding is not supported by ~DG.
+        """
+        bitmap = self.get_bitmap(filename, size)
+        encoding, _ = self.select_encoding(bitmap, upload=True)
+        return bitmap.to_upload(
+            targetfile, encoding=encoding, workers=self._workers, chunk_rows=self._chunk_rows)
+
+    def convert(self, filename=None, label=False, x=None, y=None, size=None):
+        """
+        Convert a file to ZPL.
+        See get_bitmap for supported sources.
+        Returns a full ZPL-compatible image with optional headers.
+        """
+        bitmap = self.get_bitmap(filename, size)
+        encoding, _ = self.select_encoding(bitmap)
+        return bitmap.to_zpl(
+            label=label, x=x, y=y, encoding=encoding,
+            workers=self._workers, chunk_rows=self._chunk_rows)
+
+    def _get_bw_image(self, source):
+        """
+        Convert image to black and white.
+        """
+
+        # Load image
+        image = _open_image(source)
+
+        if image.mode == '1':
+            # Already black and white, only invert
+            bwimage = image.point(lambda x: 255 - x)
+        elif self._dither:
             # Dither image by converting to mode '1' and invert result
             bwimage = image.convert('1').point(lambda x: 255 - x)
         else:
             # Convert to black and white (via grayscale)
             # conv = lambda x: 255 if x >= self._threshold else 0
-            conv = lambda x: 0 if x >= self._threshold else 255
+            threshold = self._threshold
+            conv = lambda x: 0 if x >= threshold else 255
             bwimage = image.convert('L').point(conv, mode='1')
 
-        # Calculate image size
-        self._width_bytes = (width + 7) / 8
-        self._total = self._width_bytes * height
-
         return bwimage
-
-    def _create_body(self, filename):
-        """
-        Create uncompressed body.
-        Filename can be '-' for reading data from stdin.
-        """
-
-        bwimage = self._get_bw_image(filename)
-
-        # Convert bytes to simple hex
-        idx = 0
-        result = []
-        row = ""
-        for char in bwimage.tobytes():
-            row += _int_to_hex(ord(char))
-            idx += 1
-            if idx == self._width_bytes:
-                result.append(row)
-                idx = 0
-                row = ""
-
-        return '\n'.join(result) + '\n'
-
-    def _compress_hex(self, body):
-        """
-        Compress the hex result.
-        """
-        last_line = ""
-        line = ""
-        result = ""
-        counter = 1
-        prev = ''
-        first_char = True
-
-        for char in body:
-            if first_char:
-                prev = char
-                first_char = False
-                continue
-
-            # New line, add result of previously processed line
-            if char == '\n':
-                # Continue white
-                if prev == '0':
-                    line += ','
-                # Continue black
-                elif prev == 'f':
-                    line += '!'
-                # Repeat last character
-                else:
-                    line += _get_compress(counter, prev)
-
-                # Reset line
-                counter = 1
-                first_char = True
-                # Add new line or repeat previous line
-                result += ':' if line == last_line else line
-                last_line = line
-                line = ""
-                continue
-
-            # Process bytes
-            if prev == char:
-                counter += 1
-            else:
-                line += _get_compress(counter, prev)
-                counter = 1
-                prev = char
-
-        return result
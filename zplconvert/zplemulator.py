@@ -0,0 +1,587 @@
+"""
+Local Zebra printer emulator for testing without hardware.
+"""
+
+import re
+import sys
+import time
+import base64
+import logging
+import argparse
+import threading
+import SocketServer
+from collections import deque
+from cStringIO import StringIO
+from PIL import Image
+
+from .zplparser import (GFA_MATCHER, GFB_MATCHER, zpl_decode, zpl_decode_bits,
+                        zpl_parse_data)
+
+LOG = logging.getLogger(__name__)
+
+DG_MATCHER = re.compile(r"~DG([^,]+),([0-9]+),([0-9]+),")
+DY_MATCHER = re.compile(r"~DY([^,]+),(\w),(\w+),([0-9]*),([0-9]*),")
+
+# Commands answered immediately with a reply
+QUERY_COMMANDS = ('~HI', '~HM', '~HS')
+
+# Commands kept in the receive buffer until printed
+DOWNLOAD_COMMANDS = ('~DG', '~DY')
+
+# Receive buffer size, if not given
+DEFAULT_BUFFER_SIZE = 65536
+
+# Bytes searched again for a command end split between receives
+SCAN_OVERLAP = 64
+
+WHITESPACE = re.compile(r"\s*")
+
+DEFAULT_IDENT = {
+    'model': 'ZT410-203dpi',
+    'version': 'V75.20.01Z',
+    'dpm': 8,
+    'memory': 8192,
+    'options': 'F',
+}
+
+DEFAULT_RAM = {
+    'max': 8192,
+    'total': 8192,
+    'free': 7680,
+}
+
+DEFAULT_STATUS = {
+    'interface': 30,
+    'paper_out': False,
+    'pause': False,
+    'label_length': 1218,
+    'num_formats': 0,
+    'buffer_full': False,
+    'diagnostic_mode': False,
+    'format_in_progress': False,
+    'corrupt_ram': False,
+    'under_temp': False,
+    'over_temp': False,
+    'function_settings': 1,
+    'head_up': False,
+    'ribbon_out': False,
+    'thermal_transfer_mode': True,
+    'print_mode': '2',
+    'print_width_mode': 6,
+    'label_waiting': False,
+    'labels_remaining': 0,
+    'graphics_in_mem': 0,
+    'password': '1234',
+    'static_ram': False,
+}
+
+def _next_command(data, start):
+    """
+    Get index of the next command prefix, or -1 if none.
+    """
+    indexes = [idx for idx in (data.find('^', start), data.find('~', start)) if idx != -1]
+    return min(indexes) if indexes else -1
+
+def _find_format_end(data, start):
+    """
+    Get index of the ^XZ ending a format, or -1 if not yet received,
+    and the index to continue searching from when more data is received.
+    Binary graphic field data is skipped, as it may contain ^XZ.
+    """
+    while True:
+        end = data.find('^XZ', start)
+        match = GFB_MATCHER.search(data, start)
+        if match is None or (end != -1 and end < match.start()):
+            if end == -1:
+                return -1, max(start, len(data) - SCAN_OVERLAP)
+            return end, end
+        start = match.end() + int(str(match.group(1)))
+        if start > len(data):
+            return -1, start
+
+def _find_command_end(data, pos, start):
+    """
+    Get end of a download or unknown command, or -1 if not yet received,
+    and the index to continue searching from when more data is received.
+    """
+    if data[pos:pos + 3] == '~DY':
+        match = DY_MATCHER.match(data, pos)
+
+        # Binary data may contain command prefixes, so use the byte count
+        if match and match.group(2) == 'B' and match.group(4):
+            payload = match.end()
+            size = int(str(match.group(4)))
+            if len(data) - payload < min(5, size):
+                return -1, pos
+            if not data.startswith((':B64:', ':Z64:'), payload):
+                return (payload + size if payload + size <= len(data) else -1), pos
+
+    end = _next_command(data, max(pos + 1, start))
+    return end, (len(data) if end == -1 else end)
+
+def _format_ident(ident):
+    """
+    Format ~HI reply.
+    """
+    return "\x02{model},{version},{dpm},{memory}KB,{options}\x03".format(**ident)
+
+def _format_ram(ram):
+    """
+    Format ~HM reply.
+    """
+    return "\x02{max},{total},{free}\x03".format(**ram)
+
+def _format_status(status):
+    """
+    Format ~HS reply.
+    """
+    values = dict((key, int(value)) if isinstance(value, bool) else (key, value)
+                  for key, value in status.items())
+    return ("\x02{interface:03d},{paper_out},{pause},{label_length:04d},"
+            "{num_formats:03d},{buffer_full},{diagnostic_mode},{format_in_progress},"
+            "000,{corrupt_ram},{under_temp},{over_temp}\x03\r\n"
+            "\x02{function_settings:03d},0,{head_up},{ribbon_out},"
+            "{thermal_transfer_mode},{print_mode},{print_width_mode},{label_waiting},"
+            "{labels_remaining:08d},1,{graphics_in_mem:03d}\x03\r\n"
+            "\x02{password},{static_ram}\x03").format(**values)
+
+class _Receiver(object):
+    """
+    Parse commands from a single connection as data is received.
+    """
+
+    # pylint: disable=protected-access
+
+    def __init__(self, emulator, reply):
+        self._emulator = emulator
+        self._reply = reply
+        self._data = bytearray()
+        # Where to continue searching for the end of the first command
+        self._resume = 0
+
+    @property
+    def rest(self):
+        """
+        Received data not yet processed.
+        """
+        return str(self._data)
+
+    def feed(self, chunk, final=False):
+        """
+        Process all complete commands, after adding chunk to the received data.
+        The chunk is added to the receive buffer, blocking while it is full.
+        Host queries are answered in order, after the data before them has
+        been received, and take no buffer space.
+        """
+        emulator = self._emulator
+        data = self._data
+        unreceived = len(data)
+        data += chunk
+        formats = 0
+        pos = 0
+        while True:
+            pos = WHITESPACE.match(data, pos).end()
+            if pos == len(data) or (len(data) - pos < 3 and not final):
+                break
+
+            command = str(data[pos:pos + 3])
+            if command in QUERY_COMMANDS:
+                emulator.accept(max(0, pos - unreceived), formats)
+                formats = 0
+                unreceived = max(unreceived, pos + 3)
+                emulator._handle_query(command, self._reply)
+                pos += 3
+                continue
+
+            if command == '^XA':
+                end, self._resume = _find_format_end(data, max(pos, self._resume))
+                if end == -1:
+                    break
+                emulator._handle_format(str(data[pos:end + 3]))
+                formats += 1
+                pos = end + 3
+                self._resume = 0
+                continue
+
+            # Downloads and unknown commands run until the next command
+            end, self._resume = _find_command_end(data, pos, max(pos, self._resume))
+            if end == -1:
+                if not final:
+                    break
+                end = len(data)
+            emulator._handle_command(str(data[pos:end]))
+            if command in DOWNLOAD_COMMANDS:
+                formats += 1
+            pos = end
+            self._resume = 0
+
+        emulator.accept(max(0, len(data) - unreceived), formats)
+
+        if final and pos < len(data):
+            LOG.warning("Discarding incomplete command: %r", str(data[pos:pos + 20]))
+            pos = len(data)
+        del data[:pos]
+        self._resume = max(0, self._resume - pos)
+
+class _EmulatorHandler(SocketServer.BaseRequestHandler):
+    """
+    Handle a single printer connection.
+    """
+
+    def handle(self):
+        receiver = _Receiver(self.server.emulator, self.request.sendall)
+        while True:
+            chunk = self.request.recv(4096)
+            if not chunk:
+                break
+            receiver.feed(chunk)
+
+        # Connection closed, anything left is the final command
+        receiver.feed('', final=True)
+
+class _EmulatorServer(SocketServer.ThreadingTCPServer):
+    """
+    Threaded TCP server with a reference back to the emulator.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address, emulator):
+        SocketServer.ThreadingTCPServer.__init__(self, address, _EmulatorHandler)
+        self.emulator = emulator
+
+class PrinterEmulator(object):
+    """
+    Emulate a networked Zebra printer on a local TCP port.
+
+    Incoming data fills a receive buffer of buffer_size bytes, which the
+    emulated print engine drains at rate bytes per second. When the buffer is
+    full, the emulator stops reading and reports buffer_full in ~HS. While
+    paper_out is set, the buffer is not drained at all. Host queries are
+    answered immediately and do not take buffer space.
+
+    The last history received graphics are kept in graphics, with their
+    decoded images only if keep_images is set.
+    """
+
+    # pylint: disable=too-many-instance-attributes
+
+    def __init__(self, host='127.0.0.1', port=9100, rate=None, buffer_size=None,
+                 ident=None, ram=None, status=None, decode=True, history=100,
+                 keep_images=False):
+        """
+        Initialize new emulator. Port 0 picks a free port on start.
+        """
+        self._host = host
+        self._port = port
+        self._rate = rate
+        self._buffer_size = buffer_size or DEFAULT_BUFFER_SIZE
+        self._decode = decode
+        self._keep_images = keep_images
+        self._ident = dict(DEFAULT_IDENT, **(ident or {}))
+        self._ram = dict(DEFAULT_RAM, **(ram or {}))
+        self._status = dict(DEFAULT_STATUS, **(status or {}))
+        self._lock = threading.Condition()
+        self._received = 0
+        self._consumed = 0.0
+        self._queued = deque()
+        self._stored = set()
+        self._drained = time.time()
+        self._server = None
+        self._thread = None
+        self.labels = 0
+        self.graphics = deque(maxlen=history)
+
+    @property
+    def address(self):
+        """
+        Address the emulator is listening on.
+        """
+        if self._server is not None:
+            return self._server.server_address
+        return (self._host, self._port)
+
+    def set_rate(self, rate):
+        """
+        Set receive rate in bytes per second, or None for unlimited.
+        """
+        with self._lock:
+            self._drain()
+            self._rate = rate
+            self._lock.notify_all()
+
+    def set_buffer_size(self, buffer_size):
+        """
+        Set receive buffer size in bytes.
+        """
+        with self._lock:
+            self._buffer_size = buffer_size or DEFAULT_BUFFER_SIZE
+            self._lock.notify_all()
+
+    def set_paper_out(self, paper_out=True):
+        """
+        Simulate running out of paper.
+        """
+        with self._lock:
+            self._drain()
+            self._status['paper_out'] = paper_out
+            self._lock.notify_all()
+
+    def set_buffer_full(self, buffer_full=True):
+        """
+        Force the receive buffer full, regardless of actual contents.
+        """
+        with self._lock:
+            self._status['buffer_full'] = buffer_full
+            self._lock.notify_all()
+
+    def start(self):
+        """
+        Start serving in a background thread.
+        """
+        self._server = _EmulatorServer((self._host, self._port), self)
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self.address
+
+    def stop(self):
+        """
+        Stop a running emulator.
+        """
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._thread.join()
+            self._server = None
+            self._thread = None
+
+    def serve_forever(self):
+        """
+        Serve in the current thread until interrupted.
+        """
+        self._server = _EmulatorServer((self._host, self._port), self)
+        try:
+            self._server.serve_forever()
+        finally:
+            self._server.server_close()
+            self._server = None
+
+    def _drain(self):
+        """
+        Consume bytes printed by the print engine since the last call.
+        Must be called with the lock held.
+        """
+        now = time.time()
+        if not self._status['paper_out']:
+            if self._rate is None:
+                self._consumed = self._received
+            else:
+                self._consumed = min(self._received,
+                                     self._consumed + (now - self._drained) * self._rate)
+            # Formats are printed once all their bytes are consumed
+            while self._queued and self._queued[0] <= self._consumed:
+                self._queued.popleft()
+        self._drained = now
+
+    def _is_full(self, size):
+        """
+        Check if size more bytes would not fit in the buffer.
+        Must be called with the lock held.
+        """
+        if self._status['buffer_full']:
+            return True
+        pending = self._received - self._consumed
+        # Always accept into an empty buffer, so large chunks cannot stall
+        return pending > 0 and pending + size > self._buffer_size
+
+    def accept(self, size, formats=0):
+        """
+        Block until size bytes fit in the receive buffer, then add them.
+        Formats is the number of formats and downloads completed by these
+        bytes, which stay queued until they are printed.
+        """
+        with self._lock:
+            if size > 0:
+                self._drain()
+                while self._is_full(size):
+                    self._lock.wait(0.01)
+                    self._drain()
+                self._received += size
+            self._queued.extend([self._received] * formats)
+
+    def status(self):
+        """
+        Get current status values, as reported by ~HS.
+        """
+        with self._lock:
+            self._drain()
+            status = dict(self._status)
+            status['buffer_full'] = status['buffer_full'] or \
+                self._received - self._consumed >= self._buffer_size
+            status['num_formats'] = min(999, len(self._queued))
+            status['graphics_in_mem'] = min(999, len(self._stored))
+            return status
+
+    def process(self, data, reply, final=False):
+        """
+        Process all complete commands in data, and return the unprocessed rest.
+        """
+        receiver = _Receiver(self, reply)
+        receiver.feed(data, final)
+        return receiver.rest
+
+    def _handle_query(self, command, reply):
+        """
+        Reply to a host query.
+        """
+        if command == '~HI':
+            reply(_format_ident(self._ident))
+        elif command == '~HM':
+            reply(_format_ram(self._ram))
+        elif command == '~HS':
+            reply(_format_status(self.status()))
+
+    def _handle_format(self, data):
+        """
+        Handle a complete ^XA...^XZ label format.
+        """
+        with self._lock:
+            self.labels += 1
+        LOG.info("Received label format, %d bytes", len(data))
+        for match in GFA_MATCHER.finditer(data):
+            self._log_graphic('^GFA', None, len(match.group(0)), zpl_parse_data, match.group(0))
+
+        # Binary graphic fields are as long as their byte count
+        match = GFB_MATCHER.search(data)
+        while match:
+            end = match.end() + int(match.group(1))
+            width_bytes = int(match.group(3))
+            height = int(match.group(2)) / width_bytes
+            self._log_graphic('^GFB', None, end - match.start(), zpl_decode_bits,
+                              data[match.end():end], width_bytes * 8, height)
+            match = GFB_MATCHER.search(data, end)
+
+    def _handle_command(self, data):
+        """
+        Handle a single download or unknown command.
+        """
+        if data[:3] == '~DG':
+            match = DG_MATCHER.match(data)
+            if not match:
+                LOG.warning("Invalid ~DG command: %r", data[:20])
+                return
+            name = match.group(1)
+            width_bytes = int(match.group(3))
+            height = int(match.group(2)) / max(1, width_bytes)
+            self._log_graphic('~DG', name, len(data), zpl_decode,
+                              data[match.end():], width_bytes * 8, height)
+
+        elif data[:3] == '~DY':
+            match = DY_MATCHER.match(data)
+            if not match:
+                LOG.warning("Invalid ~DY command: %r", data[:20])
+                return
+            name, fmt, extension = match.group(1), match.group(2), match.group(3)
+            payload = data[match.end():]
+            if extension == 'P':
+                self._log_graphic('~DY', name, len(data), self._decode_png, fmt, payload)
+            elif extension == 'G' and match.group(4) and match.group(5):
+                width_bytes = int(match.group(5))
+                height = int(match.group(4)) / max(1, width_bytes)
+                decoder = zpl_decode
+                if fmt == 'B' and not payload.startswith((':B64:', ':Z64:')):
+                    decoder = zpl_decode_bits
+                self._log_graphic('~DY', name, len(data), decoder,
+                                  payload, width_bytes * 8, height)
+            else:
+                LOG.info("Received file %s (%s,%s), %d bytes", name, fmt, extension, len(data))
+
+        else:
+            LOG.debug("Ignoring command: %r", data[:20])
+
+    def _log_graphic(self, command, name, size, decoder, *args):
+        """
+        Decode and record a received graphic.
+        """
+        image = None
+        if self._decode:
+            try:
+                image = decoder(*args)
+            except (ValueError, IOError) as err:
+                LOG.warning("Could not decode %s graphic %s: %s", command, name or '', err)
+
+        if image is not None:
+            LOG.info("Received %s graphic %s, %d bytes, %d x %d",
+                     command, name or '', size, image.size[0], image.size[1])
+        else:
+            LOG.info("Received %s graphic %s, %d bytes", command, name or '', size)
+
+        with self._lock:
+            if name is not None:
+                self._stored.add(name)
+            self.graphics.append({
+                'command': command,
+                'name': name,
+                'size': size,
+                'image': image if self._keep_images else None,
+            })
+
+    def _decode_png(self, fmt, payload):
+        """
+        Decode a ':B64:data:crc' or binary PNG payload.
+        """
+        if payload.startswith(':B64:'):
+            payload = base64.b64decode(payload[5:].rsplit(':', 1)[0])
+        elif fmt != 'B':
+            payload = base64.b64decode(payload)
+        image = Image.open(StringIO(payload))
+        image.load()
+        return image
+
+def parse_args():
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Emulate a Zebra printer on a local port.")
+    parser.add_argument('--host', default='127.0.0.1',
+                        help="Address to listen on (default 127.0.0.1)")
+    parser.add_argument('--port', '-p', default=9100, type=int,
+                        help="Port to listen on (default 9100)")
+    parser.add_argument('--rate', '-r', type=int,
+                        help="Receive rate in bytes per second (default unlimited)")
+    parser.add_argument('--buffer-size', '-b', type=int,
+                        help="Receive buffer size in bytes (default %d)" % DEFAULT_BUFFER_SIZE)
+    parser.add_argument('--model', '-m', default=DEFAULT_IDENT['model'],
+                        help="Model reported by ~HI")
+    parser.add_argument('--paper-out', action='store_true',
+                        help="Start with paper out")
+    parser.add_argument('--verbose', '-v', action='store_true',
+                        help="Log every received command")
+
+    return parser.parse_args()
+
+def main():
+    """
+    Main entrypoint.
+    """
+
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO,
+                        format="%(asctime)s %(message)s")
+
+    emulator = PrinterEmulator(args.host, args.port, rate=args.rate,
+                               buffer_size=args.buffer_size,
+                               ident={'model': args.model},
+                               status={'paper_out': args.paper_out})
+    print >> sys.stderr, "Emulating %s on %s:%d" % ((args.model,) + emulator.address)
+    try:
+        emulator.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""
+Load generator for measuring end-to-end label throughput against emulated printers.
+"""
+
+import sys
+import math
+import time
+import argparse
+import threading
+
+from .zplconvert import ZPLConvert
+from .zpltools import Printer, PrinterError
+from .zplemulator import PrinterEmulator
+
+# Seconds between status queries while waiting for a label to print
+POLL_INTERVAL = 0.005
+
+def _percentile(values, percent):
+    """
+    Get percentile of sorted values, using the nearest rank method.
+    """
+    if not values:
+        return 0.0
+    rank = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(0, min(rank, len(values) - 1))]
+
+def _wait_printed(printer, data):
+    """
+    Send data and wait until the printer has no formats left in its buffer.
+    """
+    # Status sent after the data is only answered once the data is received
+    status = printer.get_host_status(data)
+    while status.get('num_formats'):
+        time.sleep(POLL_INTERVAL)
+        status = printer.get_host_status()
+
+def _worker(printer, converter, labels, upload, results):
+    """
+    Convert and print labels on one printer, recording latencies.
+    """
+    for _ in xrange(labels):
+        start = time.time()
+        try:
+            if upload:
+                data = converter.convert_for_upload(upload)
+            else:
+                data = converter.convert(label=True)
+            _wait_printed(printer, data)
+        except PrinterError:
+            results['errors'] += 1
+            continue
+        results['latencies'].append(time.time() - start)
+        results['bytes'] += len(data)
+
+def run_load(filename, addresses, labels=100, compress=True, upload=None):
+    """
+    Send labels to each printer address in parallel.
+    Returns throughput and latency statistics.
+    """
+    converter = ZPLConvert(filename)
+    converter.set_compress_hex(compress)
+
+    results = []
+    threads = []
+    for host, port in addresses:
+        result = {'latencies': [], 'bytes': 0, 'errors': 0}
+        results.append(result)
+        thread = threading.Thread(target=_worker, args=(
+            Printer(host, port), converter, labels, upload, result))
+        thread.daemon = True
+        threads.append(thread)
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    latencies = sorted(sum((result['latencies'] for result in results), []))
+    return {
+        'printers': len(addresses),
+        'labels': len(latencies),
+        'errors': sum(result['errors'] for result in results),
+        'bytes': sum(result['bytes'] for result in results),
+        'elapsed': elapsed,
+        'labels_per_second': len(latencies) / elapsed if elapsed else 0.0,
+        'p50': _percentile(latencies, 50),
+        'p90': _percentile(latencies, 90),
+        'p99': _percentile(latencies, 99),
+        'max': latencies[-1] if latencies else 0.0,
+    }
+
+def parse_args():
+    """
+    Parse command line arguments.
+    """
+    parser = argparse.ArgumentParser(description="Load test label conversion and printing.",
+                                     epilog="Without --printer, local emulators are started.")
+    parser.add_argument('--printer', '-P', action='append', default=[],
+                        help="Printer address host[:port], can be repeated")
+    parser.add_argument('--emulators', '-e', default=1, type=int,
+                        help="Number of local emulators to start (default 1)")
+    parser.add_argument('--rate', '-r', type=int,
+                        help="Emulator receive rate in bytes per second")
+    parser.add_argument('--buffer-size', '-b', type=int,
+                        help="Emulator receive buffer size in bytes")
+    parser.add_argument('--labels', '-l', default=100, type=int,
+                        help="Labels to send per printer (default 100)")
+    parser.add_argument('--no-compress', '-n', action='store_false', dest='compress',
+                        help="Do not compress the images")
+    parser.add_argument('--upload', '-u',
+                        help="Upload graphic with this name instead of printing labels")
+    parser.add_argument('filename', help="Source image filename")
+
+    return parser.parse_args()
+
+def main():
+    """
+    Main entrypoint.
+    """
+
+    args = parse_args()
+
+    emulators = []
+    addresses = []
+    for printer in args.printer:
+        host, _, port = printer.partition(':')
+        addresses.append((host, int(port or 9100)))
+
+    if not addresses:
+        for _ in xrange(args.emulators):
+            emulator = PrinterEmulator(port=0, rate=args.rate,
+                                       buffer_size=args.buffer_size, decode=False)
+            addresses.append(emulator.start())
+            emulators.append(emulator)
+
+    try:
+        stats = run_load(args.filename, addresses, args.labels, args.compress, args.upload)
+    finally:
+        for emulator in emulators:
+            emulator.stop()
+
+    print "Printers:      %d" % stats['printers']
+    print "Labels:        %d (%d errors)" % (stats['labels'], stats['errors'])
+    print "Bytes sent:    %d" % stats['bytes']
+    print "Elapsed:       %.3f s" % stats['elapsed']
+    print "Labels/second: %.1f" % stats['labels_per_second']
+    print "Latency (ms):  p50 %.1f, p90 %.1f, p99 %.1f, max %.1f" % tuple(
+        stats[key] * 1000 for key in ('p50', 'p90', 'p99', 'max'))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -4,12 +4,17 @@ Convert ZPL image back to regular image.
 
 import re
 import sys
+import zlib
+import base64
 import argparse
 from cStringIO import StringIO
 from PIL import Image
 
 GFA_MATCHER = re.compile(r"\^GFA,([1-9][0-9]*),([1-9][0-9]*),([1-9][0-9]*),([^\^]+)\^FS")
 
+# Binary data may contain any bytes, only the header is matched
+GFB_MATCHER = re.compile(r"\^GFB,([1-9][0-9]*),([1-9][0-9]*),([1-9][0-9]*),")
+
 def _hex_nibble_to_bytes(value):
     """
     Convert ZPL byte to image bytes.
@@ -20,6 +25,16 @@ def _hex_nibble_to_bytes(value):
             ('\x00' if val & 2 == 2 else '\xff') +
             ('\x00' if val & 1 == 1 else '\xff'))
 
+def _decode_base64(data):
+    """
+    Decode :B64: or :Z64: data to packed bytes.
+    """
+    encoded = data[5:].rsplit(':', 1)[0]
+    decoded = base64.b64decode(encoded)
+    if data.startswith(':Z64:'):
+        decoded = zlib.decompress(decoded)
+    return decoded
+
 def _get_dimensions(match):
     """
     Get image size.
@@ -28,29 +43,24 @@ def _get_dimensions(match):
     width_bytes = int(match.group(3))
     return width_bytes * 8, total / width_bytes
 
-def zpl_parse(filename):
+def zpl_decode_bits(bits, width, height):
     """
-    Convert a ZPL file back to an image.
+    Decode packed bits, with set bits black, to an image.
     """
+    if len(bits) != width * height / 8:
+        raise ValueError("Parsed byte count does not match")
+    image = Image.frombytes('1', (width, height), bits)
+    return image.point(lambda x: 255 - x)
 
-    # pylint: disable=too-many-locals,too-many-statements
-
-    if not filename:
-        raise ValueError("No filename given, or empty")
-
-    source = sys.stdin if filename == '-' else open(filename)
-    data = source.read()
-
-    # Find start of an image
-    match = GFA_MATCHER.search(data)
-
-    if not match:
-        raise ValueError("Could not find ZPL image")
-
-    # Calculate image size
-    width, height = _get_dimensions(match)
+def zpl_decode(data, width, height):
+    """
+    Decode ZPL graphic field data (plain or compressed hex, :B64: or :Z64:) to an image.
+    """
 
-    print "Calculated image size: %d x %d" % (width, height)
+    # Base64 data is packed bits
+    stripped = data.strip()
+    if stripped.startswith((':B64:', ':Z64:')):
+        return zpl_decode_bits(_decode_base64(stripped), width, height)
 
     # Convert length multiplier to character code
     # G - Y = 1 - 19, g - z = 20 - 400
@@ -65,9 +75,13 @@ def zpl_parse(filename):
     result = ""
     rowdata = ""
     lastrow = ""
-    for char in match.group(4):
+    for char in data:
+        # Line breaks are only for readability
+        if char in '\r\n':
+            continue
+
         # Continue current line until the end with white
-        if char == ',':
+        elif char == ',':
             rowdata += '\xff' * (width - col)
             nextrow = True
 
@@ -102,14 +116,54 @@ def zpl_parse(filename):
             col = 0
             row += 1
 
-    assert row == height, "Image height does not match"
-    assert len(result) == width * height, "Parsed byte count does not match"
+    if row != height:
+        raise ValueError("Image height does not match")
+    if len(result) != width * height:
+        raise ValueError("Parsed byte count does not match")
 
     # Create new image from data
     image = Image.frombytes('L', (width, height), result).convert('1')
 
     return image
 
+def zpl_parse_data(data):
+    """
+    Convert the first ZPL image (^GFA or ^GFB) found in a string back to an image.
+    """
+
+    # Find start of an image
+    match = GFA_MATCHER.search(data)
+    binary = GFB_MATCHER.search(data)
+
+    if not match and not binary:
+        raise ValueError("Could not find ZPL image")
+
+    # Binary data is as long as its byte count
+    if binary and (not match or binary.start() < match.start()):
+        width, height = _get_dimensions(binary)
+        bits = data[binary.end():binary.end() + int(binary.group(1))]
+        return zpl_decode_bits(bits, width, height)
+
+    # Calculate image size
+    width, height = _get_dimensions(match)
+
+    return zpl_decode(match.group(4), width, height)
+
+def zpl_parse(filename):
+    """
+    Convert a ZPL file back to an image.
+    """
+
+    if not filename:
+        raise ValueError("No filename given, or empty")
+
+    source = sys.stdin if filename == '-' else open(filename, 'rb')
+    image = zpl_parse_data(source.read())
+
+    print "Calculated image size: %d x %d" % image.size
+
+    return image
+
 def parse_args():
     """
     Parse command line arguments.
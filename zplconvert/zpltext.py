@@ -0,0 +1,168 @@
+"""
+Render text to ZPL images with cached glyphs.
+"""
+
+import threading
+from collections import OrderedDict
+from PIL import Image, ImageDraw, ImageFont
+
+from .zplconvert import ZPLBitmap
+
+def _get_advance(font, text):
+    """
+    Get advance width of text, including kerning.
+    """
+    if hasattr(font, 'getlength'):
+        return int(round(font.getlength(text)))
+    # Older Pillow only measures ink, a trailing space has none
+    return font.getsize(text + ' ')[0] - font.getsize(' ')[0]
+
+class _LRUCache(object):
+    """
+    Bounded cache, dropping the least recently used items first.
+    """
+
+    def __init__(self, size):
+        self._size = size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, create):
+        """
+        Get cached item, creating it with create(key) if missing.
+        """
+        with self._lock:
+            if key in self._items:
+                value = self._items.pop(key)
+                self._items[key] = value
+                return value
+
+        # Create outside the lock, a duplicate is harmless
+        value = create(key)
+
+        with self._lock:
+            self._items[key] = value
+            while len(self._items) > self._size:
+                self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        """
+        Remove all cached items.
+        """
+        with self._lock:
+            self._items.clear()
+
+class ZPLText(object):
+    """
+    Render text in a TrueType or OpenType font to ZPL images.
+    Glyphs are rendered once and kept in a bounded cache, so each
+    rendered string only costs copying the cached glyph bitmaps.
+    """
+
+    def __init__(self, font, size=None, cache_size=1024, spacing=0):
+        """
+        Initialize new renderer.
+        Font is a font filename with size in pixels, or a FreeTypeFont.
+        Spacing is extra space in pixels between lines.
+        """
+        if isinstance(font, ImageFont.FreeTypeFont):
+            self._font = font
+        else:
+            if not size:
+                raise ValueError("No font size given")
+            self._font = ImageFont.truetype(font, size)
+        ascent, descent = self._font.getmetrics()
+        self._ascent = ascent
+        self._line_height = ascent + descent
+        self._spacing = spacing
+        self._glyphs = _LRUCache(cache_size)
+        self._kerning = _LRUCache(cache_size * 4)
+
+    def render(self, text):
+        """
+        Render text to a bitmap. Lines are separated with '\\n'.
+        A str is decoded as UTF-8.
+        Returns a ZPLBitmap with black text on white.
+        """
+        if isinstance(text, str):
+            text = text.decode('utf-8')
+        lines = [self._layout(line) for line in text.split('\n')]
+        left = min([0] + [line[0] for line in lines])
+        width = max([1] + [line[1] - left for line in lines])
+        height = len(lines) * (self._line_height + self._spacing) - self._spacing
+
+        # Set bits are black, which matches ZPL directly
+        canvas = Image.new('1', (width, max(1, height)), 0)
+        top = 0
+        for _, _, placed in lines:
+            for glyph, x, y in placed:
+                canvas.paste(1, (x - left, top + y), glyph)
+            top += self._line_height + self._spacing
+
+        return ZPLBitmap(canvas.tobytes(), canvas.size[0], canvas.size[1])
+
+    def convert(self, text, label=False, x=None, y=None, encoding='compressed'):
+        """
+        Render text to ZPL.
+        Returns a full ZPL-compatible image with optional headers.
+        """
+        return self.render(text).to_zpl(label=label, x=x, y=y, encoding=encoding)
+
+    def clear_cache(self):
+        """
+        Remove all cached glyphs.
+        """
+        self._glyphs.clear()
+        self._kerning.clear()
+
+    def _layout(self, line):
+        """
+        Place glyphs of a single line.
+        Returns leftmost and rightmost pixel and a list of (glyph, x, y).
+        """
+        placed = []
+        left, right = 0, 0
+        pen = 0
+        prev = None
+        for char in line:
+            glyph, offset_x, offset_y, advance = self._glyphs.get(char, self._render_glyph)
+            if prev is not None:
+                pen += self._kerning.get(prev + char, self._get_kerning)
+            if glyph is not None:
+                x = pen + offset_x
+                placed.append((glyph, x, offset_y))
+                left = min(left, x)
+                right = max(right, x + glyph.size[0])
+            pen += advance
+            prev = char
+
+        return left, max(right, pen), placed
+
+    def _render_glyph(self, char):
+        """
+        Render a single glyph.
+        Returns the cropped glyph bitmap, or None if it has no ink,
+        its offset from the pen position and its advance width.
+        """
+        advance = _get_advance(self._font, char)
+
+        # Leave room for glyphs extending past their advance on either side
+        pad = self._line_height
+        image = Image.new('1', (advance + 2 * pad, self._line_height + pad), 0)
+        ImageDraw.Draw(image).text((pad, 0), char, font=self._font, fill=1)
+
+        bbox = image.getbbox()
+        if bbox is None:
+            return None, 0, 0, advance
+        return image.crop(bbox), bbox[0] - pad, bbox[1], advance
+
+    def _get_kerning(self, pair):
+        """
+        Get kerning adjustment between two characters.
+        """
+        return (_get_advance(self._font, pair) - _get_advance(self._font, pair[0]) -
+                _get_advance(self._font, pair[1]))
@@ -125,9 +125,10 @@ class Printer(object):
             return values
         return None
 
-    def get_host_status(self):
+    def get_host_status(self, data=""):
         """
         Get printer status data.
+        Optional data is sent first on the same connection.
         """
 
         int_types = ('interface', 'label_length', 'num_formats', 'function_settings',
@@ -153,7 +154,7 @@ class Printer(object):
         }
 
         # Send command
-        info = self.send_command("~HS", True)
+        info = self.send_command(data + "~HS", True)
         match = re.match(r"\x02(?P<interface>\d{3}),"
                         r"(?P<paper_out>\d),"
                         r"(?P<pause>\d),"